@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 """Generate HTML pattern documentation from YAML files for GitHub Pages."""
 
+import os
+import pickle
 import re
-import urllib.parse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List, Tuple
 
 import yaml
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
 
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
 
-def get_detection_intent(name: str, description: str) -> str:
+SEVERITIES = ("critical", "high", "medium")
+CACHE_FILE = Path("scripts/.yaml_cache.pkl")
+# Same threshold and override as scripts/test/run.py
+PARALLEL_MIN_FILES = 64
+PATTERN_ID_TABLE = str.maketrans("_ ", "--")
+INLINE_FLAGS_RE = re.compile(r"\(\?[imsxADSUXJ-]+\)")
+
+
+def get_detection_intent(description: str) -> str:
     if "Detects" in description:
         parts = description.split("Detects", 1)
         if len(parts) > 1:
@@ -26,12 +42,11 @@ def get_detection_intent(name: str, description: str) -> str:
 
 
 def clean_regex_for_javascript(pattern: str) -> str:
-    cleaned = re.sub(r"\(\?[imsxADSUXJ-]+\)", "", pattern)
-    return cleaned
+    return INLINE_FLAGS_RE.sub("", pattern)
 
 
 def generate_pattern_id(name: str) -> str:
-    return name.replace("_", "-").replace(" ", "-").lower()
+    return name.translate(PATTERN_ID_TABLE).lower()
 
 
 def format_pattern_name(name: str) -> str:
@@ -40,9 +55,7 @@ def format_pattern_name(name: str) -> str:
     if len(parts) < 3:
         return name
     number = parts[1]
-    description = "-".join(parts[2:])
-    description_words = description.split("-")
-    formatted_description = " ".join(word.capitalize() for word in description_words)
+    formatted_description = " ".join(word.capitalize() for word in parts[2:])
 
     return f"[{number}] {formatted_description}"
 
@@ -53,28 +66,90 @@ def extract_malicious_examples(pattern_data: Dict) -> List[str]:
     return []
 
 
-def load_patterns(patterns_dir: Path) -> Dict[str, List[Tuple]]:
-    patterns_by_severity = {
-        "critical": [],
-        "high": [],
-        "medium": [],
-    }
+def load_cache() -> Dict[str, Tuple]:
+    try:
+        with CACHE_FILE.open("rb") as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, ValueError, TypeError, pickle.PickleError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_cache(cache: Dict[str, Tuple]):
+    # Write then rename so an interrupted or concurrent build never leaves a
+    # partial cache; the cache is optional, so failing to write it is not fatal
+    tmp_file = CACHE_FILE.with_name(f"{CACHE_FILE.name}.{os.getpid()}.tmp")
+    try:
+        with tmp_file.open("wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, CACHE_FILE)
+    except OSError:
+        tmp_file.unlink(missing_ok=True)
+
+
+def parse_pattern_file(yaml_file: Path) -> Dict:
+    return yaml.load(yaml_file.read_bytes(), Loader=Loader)
+
+
+def parallel_min_files() -> int:
+    value = os.environ.get("CLICKFIX_PARALLEL_MIN_FILES")
+    if value is None:
+        return PARALLEL_MIN_FILES
+    try:
+        return int(value)
+    except ValueError:
+        print(
+            f"Warning: CLICKFIX_PARALLEL_MIN_FILES={value!r} is not an integer, "
+            f"using {PARALLEL_MIN_FILES}",
+            file=sys.stderr,
+        )
+        return PARALLEL_MIN_FILES
+
+
+def parse_pattern_files(yaml_files: List[Path]) -> List[Dict]:
+    if len(yaml_files) < parallel_min_files():
+        return [parse_pattern_file(yaml_file) for yaml_file in yaml_files]
+    with ProcessPoolExecutor() as executor:
+        return list(executor.map(parse_pattern_file, yaml_files, chunksize=4))
 
-    for yaml_file in sorted(patterns_dir.glob("*.yaml")):
-        pattern_data = yaml.safe_load(yaml_file.read_text())
-        severity = pattern_data["severity"]
-        if severity in patterns_by_severity:
-            patterns_by_severity[severity].append((yaml_file, pattern_data))
+
+def load_patterns(patterns_dir: Path) -> Dict[str, List[Tuple]]:
+    patterns_by_severity = {severity: [] for severity in SEVERITIES}
+
+    cache = load_cache()
+    fresh_cache = {}
+    with os.scandir(patterns_dir) as it:
+        entries = [e for e in it if e.name.endswith(".yaml")]
+    entries.sort(key=lambda e: e.name)
+
+    loaded = []
+    stale = []
+    for entry in entries:
+        stat = entry.stat()
+        cached = cache.get(entry.path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            loaded.append((entry.path, stat, cached[2]))
+        else:
+            loaded.append((entry.path, stat, None))
+            stale.append(Path(entry.path))
+
+    parsed = iter(parse_pattern_files(stale))
+    for key, stat, pattern_data in loaded:
+        if pattern_data is None:
+            pattern_data = next(parsed)
+        fresh_cache[key] = (stat.st_mtime_ns, stat.st_size, pattern_data)
+        bucket = patterns_by_severity.get(pattern_data["severity"])
+        if bucket is not None:
+            bucket.append((Path(key), pattern_data))
+
+    if fresh_cache != cache:
+        save_cache(fresh_cache)
 
     return patterns_by_severity
 
 
 def prepare_template_data(patterns_by_severity: Dict[str, List[Tuple]]) -> Dict:
-    total_count = (
-        len(patterns_by_severity["critical"])
-        + len(patterns_by_severity["high"])
-        + len(patterns_by_severity["medium"])
-    )
+    total_count = sum(len(patterns_by_severity[severity]) for severity in SEVERITIES)
 
     severity_configs = [
         ("critical", "Critical", "Critical"),
@@ -94,7 +169,7 @@ def prepare_template_data(patterns_by_severity: Dict[str, List[Tuple]]) -> Dict:
                     "name": data["name"],
                     "display_name": format_pattern_name(data["name"]),
                     "description": data["description"].strip(),
-                    "intent": get_detection_intent(data["name"], data["description"]),
+                    "intent": get_detection_intent(data["description"]),
                     "regex": regex_pattern,
                     "js_regex": js_regex_pattern,
                     "malicious_examples": extract_malicious_examples(data),
@@ -118,18 +193,32 @@ def prepare_template_data(patterns_by_severity: Dict[str, List[Tuple]]) -> Dict:
     }
 
 
+@lru_cache(maxsize=None)
+def get_template(template_dir: Path, name: str) -> Template:
+    env = Environment(
+        loader=FileSystemLoader(template_dir),
+        bytecode_cache=FileSystemBytecodeCache(),
+        auto_reload=False,
+    )
+    return env.get_template(name)
+
+
 def generate_html_documentation(output_dir: Path):
     patterns_dir = Path("patterns")
     template_dir = Path("scripts/docs")
     patterns_by_severity = load_patterns(patterns_dir)
     template_data = prepare_template_data(patterns_by_severity)
-    env = Environment(loader=FileSystemLoader(template_dir))
-    env.filters["urlencode"] = lambda s: urllib.parse.quote(s, safe="")
-    template = env.get_template("template.html")
-    html = template.render(**template_data)
+    template = get_template(template_dir, "template.html")
     output_dir.mkdir(parents=True, exist_ok=True)
     html_file = output_dir / "index.html"
-    html_file.write_text(html)
+    # Stream into a temporary file so a failed render leaves the old page intact
+    tmp_file = html_file.with_name(f"{html_file.name}.{os.getpid()}.tmp")
+    try:
+        template.stream(**template_data).dump(str(tmp_file), encoding="utf-8")
+        os.replace(tmp_file, html_file)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
 
 
 def main():
@@ -1,13 +1,49 @@
 #!/usr/bin/env python3
 """ClickFix Pattern Test Runner."""
 
+import argparse
+import os
 import re
 import sys
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from pathlib import Path
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
+# Opt in to checking every verdict against google-re2 as well; re stays the
+# engine of record since RE2's \s, \w and $ differ from JavaScript RegExp
+USE_RE2 = os.environ.get("CLICKFIX_RE2") == "1"
 PATTERNS_DIR = Path("patterns")
+SEVERITIES = ("critical", "high", "medium")
+FALSE_NEGATIVE = "FALSE NEGATIVE - Should block"
+FALSE_POSITIVE = "FALSE POSITIVE - Should allow"
+ENGINE_MISMATCH = "ENGINE MISMATCH - re and RE2 disagree"
+# Below this many files, process pool startup costs more than working serially;
+# set CLICKFIX_PARALLEL_MIN_FILES=1 to force the pool
+PARALLEL_MIN_FILES = 64
+LEADING_FLAGS_RE = re.compile(r"\(\?([aiLmsux]+)\)")
+GROUP_REF_RE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+@dataclass(slots=True)
+class TestResult:
+    """Outcome of testing one pattern file.
+
+    Failures are (name, kind, text, matched_by) records, formatted only when
+    printed; kind is None for errors loading or compiling the file.
+    """
+
+    passed: int = 0
+    failed: int = 0
+    failures: list[tuple] = field(default_factory=list)
 
 
 def check_format(pattern: str) -> str | None:
@@ -22,60 +58,240 @@ def check_format(pattern: str) -> str | None:
     return None
 
 
-def compile_patterns(data: dict) -> list[re.Pattern]:
-    """Extract and compile regex patterns from pattern data."""
-    patterns = []
+@lru_cache(maxsize=None)
+def compile_regex(pattern: str) -> re.Pattern:
+    """Compile a pattern regex, reusing earlier compilations of the same source."""
+    return re.compile(pattern, re.DOTALL)
+
+
+@lru_cache(maxsize=None)
+def load_re2():
+    """Import google-re2 with its options, or return None if it is unavailable.
+
+    Only called under CLICKFIX_RE2=1. Other packages also install a module
+    named re2 without the google-re2 API, so those count as unavailable.
+    """
+    try:
+        import re2
+
+        options = re2.Options()
+    except (ImportError, AttributeError):
+        return None
+    options.dot_nl = True
+    options.log_errors = False
+    return re2, options
+
+
+@lru_cache(maxsize=None)
+def compile_re2(pattern: str):
+    """Compile a pattern regex with RE2, or return None if RE2 cannot parse it."""
+    re2, options = load_re2()
+    try:
+        return re2.compile(pattern, options)
+    except re2.error:
+        return None
+
+
+def compile_re2_patterns(name: str, patterns: list[re.Pattern]) -> list | None:
+    """Compile patterns with RE2 for the parity check, warning if unsupported."""
+    re2_patterns = [compile_re2(p.pattern) for p in patterns]
+    if None in re2_patterns:
+        print(
+            f"Warning: {name}: RE2 cannot compile pattern, checked with re only",
+            file=sys.stderr,
+        )
+        return None
+    return re2_patterns
+
+
+def compile_patterns(
+    data: dict,
+) -> tuple[list[re.Pattern], list[tuple[str, re.Pattern]]]:
+    """Extract and compile regex patterns from pattern data.
 
+    Returns (patterns, sub_patterns). Each sub-pattern is validated and
+    compiled on its own, so errors name the sub-pattern at fault, and is
+    returned with its name for attributing false positives. patterns is a
+    fused alternation when the sub-patterns combine cleanly.
+    """
     if data.get("patterns"):
+        sub_patterns = []
         for p in data["patterns"]:
             pattern = p["pattern"].strip()
             if err := check_format(pattern):
                 raise ValueError(f"{p['name']}: {err}")
-            patterns.append(re.compile(pattern, re.DOTALL))
+            try:
+                sub_patterns.append((p["name"], compile_regex(pattern)))
+            except re.error as e:
+                raise ValueError(f"{p['name']}: {e}") from e
+        return fuse_patterns([p for _, p in sub_patterns]), sub_patterns
     elif data.get("pattern"):
         pattern = data["pattern"].strip()
         if err := check_format(pattern):
             raise ValueError(err)
-        patterns.append(re.compile(pattern, re.DOTALL))
+        return [compile_regex(pattern)], []
     else:
         raise ValueError("Missing pattern")
 
-    return patterns
 
+def combine_patterns(sources: list[str]) -> str | None:
+    """Join sub-pattern sources into one alternation.
+
+    Leading inline flags become scoped groups, since global flags are only
+    valid at the start of an expression. Returns None for patterns using
+    group references (backreferences or conditionals), as joining them would
+    silently renumber their groups.
+    """
+    if any(GROUP_REF_RE.search(s) for s in sources):
+        return None
+
+    branches = []
+    for source in sources:
+        if m := LEADING_FLAGS_RE.match(source):
+            branches.append(f"(?{m[1]}:{source[m.end():]})")
+        else:
+            branches.append(f"(?:{source})")
+    return "|".join(branches)
+
+
+def fuse_patterns(patterns: list[re.Pattern]) -> list[re.Pattern]:
+    """Fuse compiled sub-patterns so each line needs a single search.
+
+    Falls back to the separate patterns when the alternation does not
+    compile, e.g. when sub-patterns reuse a group name.
+    """
+    if len(patterns) < 2:
+        return patterns
+    combined = combine_patterns([p.pattern for p in patterns])
+    if combined is None:
+        return patterns
+    try:
+        return [compile_regex(combined)]
+    except re.error:
+        return patterns
+
+
+def matches(searches: list, line: str) -> bool:
+    """Check whether any of the bound search methods matches the line."""
+    for search in searches:
+        if search(line) is not None:
+            return True
+    return False
+
+
+def matching_subpatterns(
+    sub_patterns: Sequence[tuple[str, re.Pattern]], line: str
+) -> list[str]:
+    """Name the sub-patterns that match a line, to attribute a false positive."""
+    return [name for name, p in sub_patterns if p.search(line) is not None]
+
+
+def run_tests(
+    patterns: list[re.Pattern],
+    malicious: list,
+    benign: list,
+    fail_fast: bool = False,
+    sub_patterns: Sequence[tuple[str, re.Pattern]] = (),
+    re2_patterns: list | None = None,
+) -> tuple[int, list[tuple]]:
+    """Run tests and return (tests_run, failures) as (kind, line, matched_by).
 
-def run_tests(patterns: list[re.Pattern], malicious: list, benign: list) -> list[str]:
-    """Run tests and return list of failure messages."""
+    With fail_fast, stops at the first failure. For multi-pattern files,
+    sub_patterns are only searched individually to attribute false positives.
+    With re2_patterns, every line the re verdict gets right is also checked
+    for the same verdict under RE2.
+    """
+    searches = [p.search for p in patterns]
+    re2_searches = [p.search for p in re2_patterns] if re2_patterns else None
+    cases = [(line, True) for line in malicious] + [(line, False) for line in benign]
     failures = []
-    for line in malicious:
-        if line.strip() and not any(p.search(line) for p in patterns):
-            failures.append(f"FALSE NEGATIVE - Should block: {line[:80]}")
-    for line in benign:
-        if line.strip() and any(p.search(line) for p in patterns):
-            failures.append(f"FALSE POSITIVE - Should allow: {line[:80]}")
-    return failures
+    for i, (line, should_match) in enumerate(cases):
+        if not line.strip():
+            continue
+        matched = matches(searches, line)
+        if matched != should_match:
+            if matched:
+                hits = matching_subpatterns(sub_patterns, line)
+                failures.append((FALSE_POSITIVE, line, tuple(hits)))
+            else:
+                failures.append((FALSE_NEGATIVE, line, ()))
+        elif re2_searches and matches(re2_searches, line) != matched:
+            failures.append((ENGINE_MISMATCH, line, ()))
+        else:
+            continue
+        if fail_fast:
+            return i + 1, failures
+    return len(cases), failures
 
 
-def test_pattern(yaml_file: Path) -> tuple[int, int, list[str]]:
-    """Test a pattern file. Returns (passed, failed, failure_messages)."""
+def test_pattern(yaml_file: Path, fail_fast: bool = False) -> TestResult:
+    """Test a pattern file."""
     name = yaml_file.stem
     try:
-        data = yaml.safe_load(yaml_file.read_text())
-        patterns = compile_patterns(data)
+        data = yaml.load(yaml_file.read_bytes(), Loader=Loader)
+        patterns, sub_patterns = compile_patterns(data)
         malicious = data.get("malicious", [])
         benign = data.get("benign", [])
-        test_failures = run_tests(patterns, malicious, benign)
-        failures = [f"{name}: {f}" for f in test_failures]
-        total = len(malicious) + len(benign)
+        re2_patterns = compile_re2_patterns(name, patterns) if USE_RE2 else None
+        total, test_failures = run_tests(
+            patterns, malicious, benign, fail_fast, sub_patterns, re2_patterns
+        )
+        failures = [(name, *f) for f in test_failures]
     except Exception as e:
-        return 0, 1, [f"{name}: {e}"]
+        return TestResult(failed=1, failures=[(name, None, str(e), ())])
+
+    return TestResult(total - len(failures), len(failures), failures)
+
+
+def parallel_min_files() -> int:
+    """Return the process pool threshold, honouring CLICKFIX_PARALLEL_MIN_FILES."""
+    value = os.environ.get("CLICKFIX_PARALLEL_MIN_FILES")
+    if value is None:
+        return PARALLEL_MIN_FILES
+    try:
+        return int(value)
+    except ValueError:
+        print(
+            f"Warning: CLICKFIX_PARALLEL_MIN_FILES={value!r} is not an integer, "
+            f"using {PARALLEL_MIN_FILES}",
+            file=sys.stderr,
+        )
+        return PARALLEL_MIN_FILES
 
-    return total - len(failures), len(failures), failures
 
+def test_patterns(
+    yaml_files: list[Path], fail_fast: bool = False
+) -> Iterator[TestResult]:
+    """Test pattern files in order, across a process pool for large runs.
 
-def get_pattern_files() -> list[Path]:
+    Results are yielded as they complete, so callers can stop early; any
+    files not yet started are then cancelled.
+    """
+    test = partial(test_pattern, fail_fast=fail_fast)
+    if len(yaml_files) < parallel_min_files():
+        yield from map(test, yaml_files)
+        return
+    executor = ProcessPoolExecutor()
+    try:
+        yield from executor.map(test, yaml_files, chunksize=4)
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def format_failure(failure: tuple) -> str:
+    """Format a (name, kind, text, matched_by) failure record for display."""
+    name, kind, text, matched_by = failure
+    if kind is None:
+        return f"{name}: {text}"
+    message = f"{name}: {kind}: {text[:80]}"
+    if matched_by:
+        message += f" (matched by {', '.join(matched_by)})"
+    return message
+
+
+def get_pattern_files(pattern_arg: str | None = None) -> list[Path]:
     """Get list of pattern files to test."""
-    if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
-        pattern_arg = sys.argv[1]
+    if pattern_arg:
         if not pattern_arg.endswith(".yaml"):
             pattern_arg += ".yaml"
         path = PATTERNS_DIR / pattern_arg
@@ -84,33 +300,61 @@ def get_pattern_files() -> list[Path]:
             sys.exit(1)
         return [path]
 
-    return (
-        sorted(PATTERNS_DIR.glob("critical-*.yaml"))
-        + sorted(PATTERNS_DIR.glob("high-*.yaml"))
-        + sorted(PATTERNS_DIR.glob("medium-*.yaml"))
+    buckets = {severity: [] for severity in SEVERITIES}
+    with os.scandir(PATTERNS_DIR) as it:
+        for entry in it:
+            severity, _, _ = entry.name.partition("-")
+            if entry.name.endswith(".yaml") and severity in buckets:
+                buckets[severity].append(entry.name)
+
+    return [
+        PATTERNS_DIR / name
+        for severity in SEVERITIES
+        for name in sorted(buckets[severity])
+    ]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Run all tests or test a specific pattern file"
+    )
+    parser.add_argument(
+        "pattern", nargs="?", help="pattern file to test, e.g. critical-04-mshta"
     )
+    parser.add_argument(
+        "--fail-fast", action="store_true", help="stop at the first failing test"
+    )
+    return parser.parse_args()
 
 
 def main():
-    yaml_files = get_pattern_files()
+    args = parse_args()
+    if USE_RE2 and load_re2() is None:
+        print("Error: CLICKFIX_RE2=1 requires the google-re2 package")
+        sys.exit(1)
+    yaml_files = get_pattern_files(args.pattern)
+    tested = 0
     total_passed = 0
     total_failed = 0
     all_failures = []
 
-    for yaml_file in yaml_files:
-        passed, failed, failures = test_pattern(yaml_file)
-        total_passed += passed
-        total_failed += failed
-        all_failures.extend(failures)
+    results = test_patterns(yaml_files, args.fail_fast)
+    for result in results:
+        tested += 1
+        total_passed += result.passed
+        total_failed += result.failed
+        all_failures.extend(result.failures)
+        if result.failed and args.fail_fast:
+            break
 
     if all_failures:
         print("\nFailures:")
         for f in all_failures:
-            print(f"  ✗ {f}")
+            print(f"  ✗ {format_failure(f)}")
         print()
 
     total = total_passed + total_failed
-    print(f"Patterns: {len(yaml_files)} | Tests: {total_passed}/{total} passed", end="")
+    print(f"Patterns: {tested} | Tests: {total_passed}/{total} passed", end="")
 
     if total_failed:
         print(f" | {total_failed} failed")
@@ -121,8 +365,4 @@ def main():
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
-        print("Usage: run.py [PATTERN]")
-        print("  Run all tests or test a specific pattern file")
-        sys.exit(0)
     main()